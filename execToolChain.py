@@ -1,57 +1,835 @@
 #!/home/josh_huang/.local/bin/python3
 import argparse
+import asyncio
+import copy
+import functools
+import hashlib
+import io
+import json
+import shutil
+import signal
+import socket
+import socketserver
 import subprocess
 import os
+import re
+import shlex
+import struct
+import sys
 
 # Global variable for the binary directory
 GOOGLEXLS_BIN="/home/josh_huang/devel/googlexls/xls-patchelf"
 
-def run_command(command, input_file, output_file, check=True):
-    """Runs a command with input file as an argument and checks for errors."""
+# glibc the XLS binaries are linked against, and its dynamic loader.
+GLIBC_LIB64 = "/home/josh_huang/.local/opt/glibc-centos9stream/usr/lib64"
+LOADER = os.path.join(GLIBC_LIB64, "ld-linux-x86-64.so.2")
+
+# Runs a tool through LOADER, for binaries whose interpreter is the system's.
+LOADER_PREFIX = (LOADER, "--library-path", GLIBC_LIB64)
+
+TOOL_PATHS = {name: os.path.join(GOOGLEXLS_BIN, name)
+              for name in ("interpreter_main", "ir_converter_main", "opt_main", "codegen_main")}
+
+# Environment for tools that are exec'd directly rather than through LOADER.
+TOOL_ENV = {**os.environ, "LD_LIBRARY_PATH": GLIBC_LIB64}
+
+# Content-addressed store of stage outputs, shared by all invocations.
+CACHE_DIR = os.path.expanduser("~/.cache/xls_toolchain")
+
+# Empty markers, named by cache_key(), for sources interpreter_main accepted.
+CHECKED_DIR = os.path.join(CACHE_DIR, "interp_ok")
+
+# Records of the command line that last produced each output, keyed by the
+# output's absolute path.
+STAMP_DIR = os.path.join(CACHE_DIR, "stamps")
+
+# Keeps every spawn on CPython's posix_spawn() fast path (vfork semantics, no
+# page-table copy), which requires close_fds=False and no cwd, preexec_fn,
+# pass_fds, process_group or stdio on fds 0-2. Not closing fds is safe:
+# Python creates all fds, including our pipes, non-inheritable (PEP 446).
+SPAWN_KWARGS = {"close_fds": False, "env": TOOL_ENV}
+
+# Socket of the `--serve` daemon; invocations forward their build to it when
+# it is up.
+SOCKET_PATH = os.path.expanduser("~/.cache/xls_toolchain.sock")
+
+# Variables of a client's environment that change what the tools load; a
+# daemon only runs builds for clients that agree with it on these.
+HANDSHAKE_ENV = ("LD_LIBRARY_PATH", "LD_PRELOAD")
+
+# Read size used when teeing one stage's stdout into the next stage.
+PIPE_CHUNK = 1 << 16
+
+def spawn(argv, stdin, stdout, stderr):
+    """Starts argv with os.posix_spawn and returns its pid.
+
+    stdin and stdout are fds to install as the child's (stdin may be None to
+    inherit ours); stderr is None to inherit or subprocess.DEVNULL. Used for
+    stages whose only result is an exit code, skipping Popen's bookkeeping.
+    """
+    file_actions = [(os.POSIX_SPAWN_DUP2, stdout, 1)]
+    if stdin is not None:
+        file_actions.append((os.POSIX_SPAWN_DUP2, stdin, 0))
+    if stderr == subprocess.DEVNULL:
+        file_actions.append((os.POSIX_SPAWN_OPEN, 2, os.devnull, os.O_WRONLY, 0))
+    # Python ignores SIGPIPE and SIGXFSZ; put them back, as Popen's
+    # restore_signals does.
+    return os.posix_spawn(argv[0], argv, TOOL_ENV, file_actions=file_actions,
+                          setsigdef=(signal.SIGPIPE, signal.SIGXFSZ))
+
+
+async def wait_pid(pid):
+    """Waits for a spawn()ed child without blocking the loop; returns its exit code."""
+    pidfd = os.pidfd_open(pid)
+    loop = asyncio.get_running_loop()
+    exited = loop.create_future()
+    loop.add_reader(pidfd, lambda: exited.done() or exited.set_result(None))
+    try:
+        await exited
+    finally:
+        loop.remove_reader(pidfd)
+        os.close(pidfd)
+    return os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1])
+
+
+async def run_command(command, input_file, output_file, stderr):
+    """Runs a command with input file as an argument and checks for errors.
+
+    Raises subprocess.CalledProcessError if the command fails.
+    """
     command_with_input = command + [input_file]
+    # Only the fd is handed to the child, which writes straight to the file;
+    # Python never sees the bytes, so there is nothing to buffer.
+    with open(output_file, 'wb', buffering=0) as outfile:
+        returncode = await wait_pid(spawn(command_with_input, None, outfile.fileno(), stderr))
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command_with_input)
+    print(f"Command executed successfully: {command_with_input}")
+
+
+def cloexec_inherited_fds():
+    """Marks every fd above stderr that we inherited as non-inheritable.
+
+    Tools are spawned with close_fds=False (see SPAWN_KWARGS), so they get
+    every inheritable fd we hold. Python opens its own fds non-inheritable,
+    but fds passed down by our parent are not. Walking /proc/self/fd touches
+    only the fds that are actually open, rather than every fd up to
+    RLIMIT_NOFILE as close_fds=True does.
+    """
     try:
-        with open(output_file, 'w') as outfile:
-            subprocess.run(command_with_input, stdout=outfile, stderr=subprocess.PIPE, check=check, text=True)
-        print(f"Command executed successfully: {command_with_input}")
-    except subprocess.CalledProcessError as e:
-        print(f"Error executing command: {command_with_input}")
-        print(f"Return code: {e.returncode}")
-        print(f"Stdout: {e.stdout}")
-        print(f"Stderr: {e.stderr}")
-        exit(1)
+        fds = [int(fd) for fd in os.listdir("/proc/self/fd")]
     except FileNotFoundError:
-        print(f"Error: Input file '{input_file}' not found.")
-        exit(1)
+        return
+    for fd in fds:
+        if fd > 2:
+            try:
+                os.set_inheritable(fd, False)
+            except OSError:
+                # The listing's own directory fd, closed by now.
+                pass
 
 
-def main():
-    parser = argparse.ArgumentParser(description="Build flow script.")
-    parser.add_argument("input_file", help="Input filename (with extension)")
+def elf_interpreter(path):
+    """Returns the PT_INTERP path of a 64-bit little-endian ELF, or None."""
+    with open(path, 'rb') as f:
+        header = f.read(64)
+        if header[:6] != b"\x7fELF\x02\x01":
+            return None
+        phoff, = struct.unpack_from("<Q", header, 32)
+        phentsize, phnum = struct.unpack_from("<HH", header, 54)
+        f.seek(phoff)
+        phdrs = f.read(phentsize * phnum)
+        for i in range(phnum):
+            p_type, _, offset, _, _, size = struct.unpack_from("<IIQQQQ", phdrs, i * phentsize)
+            if p_type == 3:  # PT_INTERP
+                f.seek(offset)
+                return f.read(size).rstrip(b"\0").decode()
+    return None
+
+
+@functools.cache
+def tool_launcher(name):
+    """Returns the argv, without flags, that runs the XLS tool `name`.
+
+    Tools whose interpreter was already patched to LOADER (patchelf
+    --set-interpreter) are exec'd directly and find glibc via TOOL_ENV;
+    anything else is still started through LOADER_PREFIX, since the system
+    loader cannot load the newer glibc. Computed once per tool per process.
+    """
+    tool = TOOL_PATHS[name]
+    try:
+        direct = elf_interpreter(tool) == LOADER
+    except OSError:
+        direct = False
+    return (tool,) if direct else LOADER_PREFIX + (tool,)
+
+
+def tool_command(name, *flags):
+    """Returns the argv prefix that runs the XLS tool `name` with `flags`."""
+    return [*tool_launcher(name), *flags]
+
+
+def file_key(path):
+    """Returns the SHA-256 hex digest of a file's contents."""
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+# Modules that DSLX resolves in its stdlib directory rather than the CWD. They
+# ship with the tools, whose mtimes are already part of every cache key.
+DSLX_BUILTIN_MODULES = {"std", "apfloat", "float32", "float64", "bfloat16"}
+
+# `import a.b.c;` / `import a.b.c as d;` and `use a::b::c;` at top level.
+DSLX_IMPORT_RE = re.compile(r"^\s*import\s+([\w.]+)(?:\s+as\s+\w+)?\s*;", re.MULTILINE)
+DSLX_USE_RE = re.compile(r"^\s*use\s+([^;]*);", re.MULTILINE)
+
+
+def find_dslx_module(pieces):
+    """Returns the file that DSLX resolves the module path `pieces` to, or None.
+
+    Mirrors FindExistingPath in xls/dslx/import_routines.cc for tools run
+    without --dslx_path: "a/b/c.x" relative to the CWD, then its parent path
+    "b/c.x" with the first piece dropped.
+    """
+    for candidate in (pieces, pieces[1:]):
+        if candidate:
+            path = os.path.join(*candidate) + ".x"
+            if os.path.isfile(path):
+                return path
+    return None
+
+
+def dslx_imports(path):
+    """Returns the non-stdlib modules the DSLX file at path transitively imports.
+
+    They are listed in a stable order. Returns None if any of them cannot be
+    resolved the way find_dslx_module() does, as the tools would then fail or
+    read a file we cannot see.
+    """
+    found = []
+    pending = [path]
+    seen = {os.path.normpath(path)}
+    while pending:
+        with open(pending.pop(), errors='replace') as f:
+            text = f.read()
+        subjects = [[match.split(".")] for match in DSLX_IMPORT_RE.findall(text)]
+        for use in DSLX_USE_RE.findall(text):
+            if "{" in use:
+                # Multi-item `use` trees are not resolved here.
+                return None
+            # `use a::b::c;` names module a/b/c.x, or member c of a/b.x.
+            pieces = [piece.strip() for piece in use.split("::")]
+            subjects.append([pieces, pieces[:-1]])
+        for candidates in subjects:
+            # Candidates are tried in order, as the tools do; a builtin one
+            # is found in the stdlib.
+            for pieces in candidates:
+                if len(pieces) == 1 and pieces[0] in DSLX_BUILTIN_MODULES:
+                    module = None
+                    break
+                module = find_dslx_module(pieces)
+                if module is not None:
+                    break
+            else:
+                return None
+            if module is not None and os.path.normpath(module) not in seen:
+                seen.add(os.path.normpath(module))
+                found.append(module)
+                pending.append(module)
+    return sorted(found)
+
+
+def dslx_key(path, imports):
+    """Returns the root cache key of the DSLX file at path.
+
+    imports is dslx_imports(path); each imported module's path and contents
+    are hashed along with the file's own, since the converter reads them too.
+    None, for imports that could not be resolved, gives a key of None.
+    """
+    if imports is None:
+        return None
+    h = hashlib.sha256(file_key(path).encode())
+    for module in imports:
+        h.update(f"\0{module}\0{file_key(module)}".encode())
+    return h.hexdigest()
+
+
+def cache_key(command, input_file, input_key):
+    """Derives a stage's cache key from its argv, input path and input's key.
+
+    Binaries named in argv (the loader and the tool) contribute their mtime and
+    size so that a toolchain upgrade invalidates previously cached outputs.
+    The input path is hashed too: the DSLX module name, and thus the mangled
+    IR names, are derived from it.
+    """
+    h = hashlib.sha256(input_key.encode())
+    for arg in command:
+        h.update(arg.encode() + b"\0")
+        if os.path.isfile(arg):
+            st = os.stat(arg)
+            h.update(f"{st.st_mtime_ns}:{st.st_size}\0".encode())
+    h.update(input_file.encode())
+    return h.hexdigest()
+
+
+def link_or_copy(src, dst):
+    """Atomically replaces dst with a hardlink to src (a copy across devices)."""
+    tmp = f"{dst}.tmp.{os.getpid()}"
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+def needs_rebuild(output_file, inputs):
+    """Returns whether output_file is missing or older than any of inputs."""
+    try:
+        built = os.stat(output_file).st_mtime_ns
+    except FileNotFoundError:
+        return True
+    return any(os.stat(path).st_mtime_ns > built for path in inputs)
+
+
+def stamp_path(output_file):
+    """Returns where the command that last produced output_file is recorded."""
+    return os.path.join(STAMP_DIR, hashlib.sha256(os.path.abspath(output_file).encode()).hexdigest())
+
+
+def command_stamp(command, input_file):
+    """Returns the text recorded by write_stamps() for one stage."""
+    return "\0".join(command + [input_file])
+
+
+def write_stamps(stages):
+    """Records the command that produced each stage's output."""
+    os.makedirs(STAMP_DIR, exist_ok=True)
+    for command, input_file, output_file in stages:
+        with open(stamp_path(output_file), 'w') as f:
+            f.write(command_stamp(command, input_file))
+
+
+def remove_stamps(stages):
+    """Forgets the commands that produced each stage's output.
+
+    Called before the stages run, so that outputs left by a run that fails
+    or is interrupted never match a stamp from an earlier, successful one.
+    """
+    for _, _, output_file in stages:
+        try:
+            os.unlink(stamp_path(output_file))
+        except FileNotFoundError:
+            pass
+
+
+def read_stamp(output_file):
+    """Returns the recorded command for output_file, or None if there is none."""
+    try:
+        with open(stamp_path(output_file)) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def first_stale_stage(stages, imports):
+    """Returns the index of the first stage whose output is out of date.
+
+    As with make, an output is up to date when it is newer than the stage's
+    input, the binaries in its argv and this script, and, since flags are not
+    files, when it was produced by the same command line. Every stage after a
+    stale one is stale too, since rerunning it rewrites their input.
+
+    imports is dslx_imports() of the first stage's input, which that stage
+    reads as well; None, for imports that could not be resolved, makes it
+    always stale.
+    """
+    if imports is None:
+        return 0
+    for i, (command, input_file, output_file) in enumerate(stages):
+        binaries = [arg for arg in command if os.path.isfile(arg)]
+        inputs = [input_file, __file__, *binaries, *([] if i else imports)]
+        if (needs_rebuild(output_file, inputs) or
+                read_stamp(output_file) != command_stamp(command, input_file)):
+            return i
+    return len(stages)
+
+
+def unlink_output(output_file):
+    """Removes a previous output, which may be a hardlink into the cache."""
+    if os.path.lexists(output_file):
+        os.unlink(output_file)
+
+
+async def write_all(fd, data):
+    """Writes data to the non-blocking fd, yielding to the loop while it is full."""
+    loop = asyncio.get_running_loop()
+    view = memoryview(data)
+    while view:
+        try:
+            view = view[os.write(fd, view):]
+        except BlockingIOError:
+            writable = loop.create_future()
+            loop.add_writer(fd, lambda: writable.done() or writable.set_result(None))
+            try:
+                await writable
+            finally:
+                loop.remove_writer(fd)
+
+
+async def tee(src, output_file, dst):
+    """Copies the pipe src into both output_file and the pipe fd dst.
+
+    dst is closed once src is exhausted. Each chunk goes to the next stage
+    before it is written to disk, so the file write is off the path between
+    the two stages.
+    """
+    forward = True
+    try:
+        with open(output_file, 'wb') as outfile:
+            while chunk := await src.read(PIPE_CHUNK):
+                if forward:
+                    try:
+                        await write_all(dst, chunk)
+                    except BrokenPipeError:
+                        # The next stage exited early. Keep draining src so
+                        # the stage feeding us runs to completion instead of
+                        # blocking.
+                        forward = False
+                outfile.write(chunk)
+    finally:
+        os.close(dst)
+
+
+async def reap_pipeline(procs, tees, pid, terminal):
+    """Kills and reaps the stages of a pipeline that is being abandoned.
+
+    A tee that fails (say, with ENOSPC) leaves the stage feeding it blocked
+    on a pipe that nobody reads, so every stage is killed; the other tees
+    then see EOF and finish. terminal is the wait_pid() task for the last
+    stage, pid; it has not reaped pid yet, so pid is still ours to signal.
+    """
+    for proc in procs:
+        try:
+            proc.kill()
+        except ProcessLookupError:
+            pass
+    terminal.cancel()
+    os.kill(pid, signal.SIGKILL)
+    await asyncio.gather(*tees, return_exceptions=True)
+    for proc in procs:
+        # Reads what a failed tee left behind, so the stdout pipe closes.
+        await proc.communicate()
+    os.waitpid(pid, 0)
+
+
+async def run_pipeline(stages, stderr):
+    """Runs (command, input_file, output_file) stages as a single pipeline.
+
+    The first stage reads input_file; each later stage reads "-" (stdin), fed
+    from the previous stage's stdout. Intermediate outputs are teed to their
+    output_file on the way through, so every artifact is still written.
+    Raises subprocess.CalledProcessError for the first stage that fails. As
+    with make's .DELETE_ON_ERROR, every output is removed if any stage fails,
+    so a partial artifact is never mistaken for an up to date one.
+    """
+    for _, _, output_file in stages:
+        unlink_output(output_file)
+    argvs = [command + ["-" if i else input_file] for i, (command, input_file, _) in enumerate(stages)]
+    try:
+        # Stages that feed another one need a StreamReader for their stdout;
+        # the last one only writes to a file, so it is spawn()ed directly.
+        procs = []
+        pipes = []
+        stdin = None
+        try:
+            with open(stages[-1][2], 'wb', buffering=0) as outfile:
+                for argv in argvs[:-1]:
+                    procs.append(await asyncio.create_subprocess_exec(
+                        *argv, stdin=stdin, stdout=asyncio.subprocess.PIPE, stderr=stderr, **SPAWN_KWARGS))
+                    if stdin is not None:
+                        os.close(stdin)
+                    stdin, write_end = os.pipe()
+                    os.set_blocking(write_end, False)
+                    pipes.append(write_end)
+                pid = spawn(argvs[-1], stdin, outfile.fileno(), stderr)
+        except OSError:
+            for proc in procs:
+                proc.kill()
+                await proc.wait()
+            for fd in pipes:
+                os.close(fd)
+            raise
+        finally:
+            if stdin is not None:
+                os.close(stdin)
+        tees = [asyncio.ensure_future(tee(proc.stdout, output_file, write_end))
+                for proc, (_, _, output_file), write_end in zip(procs, stages, pipes)]
+        terminal = asyncio.ensure_future(wait_pid(pid))
+        try:
+            await asyncio.gather(*tees)
+            returncodes = await asyncio.gather(*(proc.wait() for proc in procs), terminal)
+        finally:
+            if not terminal.done() or terminal.cancelled():
+                await reap_pipeline(procs, tees, pid, terminal)
+        # Report the first failure; later stages usually just saw truncated
+        # input.
+        for returncode, argv in zip(returncodes, argvs):
+            if returncode != 0:
+                raise subprocess.CalledProcessError(returncode, argv)
+    except BaseException:
+        for _, _, output_file in stages:
+            unlink_output(output_file)
+        raise
+    # tee() writes a chunk to disk only after the next stage has it, so an
+    # output can end up newer than the one made from it. Touch them in stage
+    # order, so that first_stale_stage() does not see the later one as stale.
+    for _, _, output_file in stages:
+        os.utime(output_file)
+    for argv in argvs:
+        print(f"Command executed successfully: {argv}")
+
+
+async def run_cached(stages, source_key, stderr):
+    """Like run_pipeline, but reuses cached outputs where they exist.
+
+    source_key is the key of the first stage's input: dslx_key() for the DSLX
+    source, else its file_key(). Keys are chained: each later stage is keyed
+    on the key of the stage that produced its input, so every key is known
+    before anything runs. Cached outputs are linked into place and the
+    pipeline starts at the first stage that misses.
+
+    Cache entries are made read-only, so that writing to an output in place,
+    which is a hardlink to its entry, fails instead of corrupting the entry
+    for every other file with the same key.
+    """
+    keys = []
+    key = source_key
+    for command, input_file, _ in stages:
+        key = cache_key(command, input_file, key)
+        keys.append(os.path.join(CACHE_DIR, key))
+    first = next((i for i, cached in enumerate(keys) if not os.path.exists(cached)), len(stages))
+    for (command, input_file, output_file), cached in zip(stages[:first], keys):
+        link_or_copy(cached, output_file)
+        # The cached file keeps its original mtime; refresh it so that
+        # first_stale_stage() sees the output as up to date next time.
+        os.utime(output_file)
+        print(f"Cache hit: {command + [input_file]}")
+    if first == len(stages):
+        return
+    await run_pipeline(stages[first:], stderr)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    for (_, _, output_file), cached in zip(stages[first:], keys[first:]):
+        link_or_copy(output_file, cached)
+        os.chmod(cached, 0o444)
+
+
+async def run_check(command, input_file, source_key, stderr):
+    """Runs the interpreter check unless it already passed for this source.
+
+    interpreter_main's output is discarded, so the only result worth keeping
+    is that it passed; that is recorded as a marker keyed like a cache entry.
+    source_key is the dslx_key() of input_file, as the interpreter also reads
+    its imports; None always runs the check.
+    """
+    if source_key is None:
+        await run_command(command, input_file, "/dev/null", stderr)
+        return
+    marker = os.path.join(CHECKED_DIR, cache_key(command, input_file, source_key))
+    if os.path.exists(marker):
+        print(f"Already checked: {command + [input_file]}")
+        return
+    await run_command(command, input_file, "/dev/null", stderr)
+    os.makedirs(CHECKED_DIR, exist_ok=True)
+    open(marker, 'w').close()
+
+
+def build_identity():
+    """Returns what a client and the daemon running its build must agree on.
+
+    That is this script's contents and the HANDSHAKE_ENV variables, so that a
+    daemon started before either changed is not used to run stale code.
+    """
+    return {"script": file_key(__file__),
+            "env": {name: os.environ.get(name) for name in HANDSHAKE_ENV}}
+
+
+class BuildServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    """Forks a child, with all modules already imported, per build request.
+
+    Plain fork() is safe here: the daemon is single-threaded and holds no fds
+    other than the listening socket, so it is already as lean as a
+    multiprocessing forkserver template would be.
+    """
+
+
+class BuildRequestHandler(socketserver.StreamRequestHandler):
+    """Runs one forwarded build and streams its output back to the client.
+
+    The request is a JSON line {"argv": [...], "cwd": "...", "identity": ...}.
+    Output, and the stderr of --verbose tools, is sent back as-is, followed by
+    "\\0<exit code>". A client whose build_identity() differs from the
+    daemon's gets "\\0mismatch" instead, and nothing is built.
+    """
+
+    def handle(self):
+        # The daemon's SIGTERM handler exits cleanly; a build that is killed
+        # must not, or the client would be told that it succeeded.
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        request = json.loads(self.rfile.readline())
+        if request.get("identity") != self.server.identity:
+            self.wfile.write(b"\0mismatch\n")
+            return
+        # Each request runs in its own forked child, so it may freely change
+        # directory and rebind stdout and stderr. The child must not keep the
+        # listening socket alive (or accept on it) for the rest of its build.
+        self.server.socket.close()
+        os.chdir(request["cwd"])
+        os.dup2(self.connection.fileno(), 2)
+        sys.stdout = sys.stderr = io.TextIOWrapper(self.wfile, write_through=True)
+        try:
+            code = build(parse_args(request["argv"]))
+        except SystemExit as e:
+            # Only argparse exits here, for a bad --batch manifest line; no
+            # exit that build() did not return is reported as a success.
+            code = e.code if isinstance(e.code, int) and e.code else 1
+        print(f"\0{code}")
+
+
+def serve():
+    """Serves builds on SOCKET_PATH until interrupted or terminated."""
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if os.path.exists(SOCKET_PATH):
+        os.unlink(SOCKET_PATH)
+    os.makedirs(os.path.dirname(SOCKET_PATH), exist_ok=True)
+    # Each request runs in a forked child, so lookups it caches die with it.
+    # Filling tool_launcher()'s cache here lets every child inherit it.
+    for name in TOOL_PATHS:
+        tool_launcher(name)
+    with BuildServer(SOCKET_PATH, BuildRequestHandler) as server:
+        server.identity = build_identity()
+        print(f"Serving builds on {SOCKET_PATH}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.unlink(SOCKET_PATH)
+
+
+def forward(argv):
+    """Runs a build on the `--serve` daemon.
+
+    Returns the build's exit code, or None if no daemon is listening or the
+    one listening does not match this script and environment.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(SOCKET_PATH)
+    except OSError:
+        sock.close()
+        return None
+    with sock, sock.makefile('rwb') as conn:
+        conn.write(json.dumps({"argv": argv, "cwd": os.getcwd(), "identity": build_identity()}).encode() + b"\n")
+        conn.flush()
+        for line in conn:
+            # Tool stderr may not end in a newline, so the status can follow
+            # other output on the same line.
+            output, status, code = line.partition(b"\0")
+            sys.stdout.buffer.write(output)
+            sys.stdout.flush()
+            if status:
+                if code.strip() == b"mismatch":
+                    print("Build server is out of date; building directly.")
+                    return None
+                return int(code)
+    print("Error: build server closed the connection.")
+    return 1
+
+
+def add_flow_flags(parser):
+    """Adds the flags that select how a file is compiled."""
     parser.add_argument("--top", help="Value for --top argument", default="add")
     parser.add_argument("--pipeline_stages", type=int, help="Value for --pipeline_stages", default=1)
     parser.add_argument("--delay_model", help="Value for --delay_model", default="unit")
 
-    args = parser.parse_args()
 
-    input_file = args.input_file
-    base_filename = os.path.splitext(input_file)[0]
+def parse_args(argv):
+    """Parses command-line flags; shared by direct and forwarded builds."""
+    parser = argparse.ArgumentParser(description="Build flow script.")
+    parser.add_argument("input_files", nargs="*", metavar="input_file", help="Input filenames (with extension)")
+    add_flow_flags(parser)
+    parser.add_argument("--batch", metavar="MANIFEST", help="File listing one input per line, optionally followed by --top/--pipeline_stages/--delay_model overrides")
+    parser.add_argument("--no_cache", action="store_true", help=f"Always run every stage, including the interpreter check, instead of reusing up-to-date outputs or those cached in {CACHE_DIR}")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="Maximum number of files in each of the check and conversion phases at once (default: number of CPUs)")
+    parser.add_argument("--verbose", action="store_true", help="Show the tools' stderr instead of discarding it")
+    parser.add_argument("--serve", action="store_true", help=f"Run a daemon on {SOCKET_PATH} that runs the builds of later invocations")
+
+    args = parser.parse_args(argv)
+    if not args.input_files and not args.batch and not args.serve:
+        parser.error("the following arguments are required: input_file")
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    return args
+
+
+def read_manifest(path, args):
+    """Returns the (flags, input_file) jobs listed in a --batch manifest.
+
+    flags is a (top, pipeline_stages, delay_model) tuple; options not given on
+    a line default to those in args. Blank lines and #-comments are skipped.
+    """
+    jobs = []
+    with open(path) as manifest:
+        for lineno, line in enumerate(manifest, 1):
+            words = shlex.split(line, comments=True)
+            if not words:
+                continue
+            parser = argparse.ArgumentParser(prog=f"{path}:{lineno}")
+            parser.add_argument("input_file")
+            add_flow_flags(parser)
+            # Parsing into a copy of args keeps its values as the defaults.
+            line_args = parser.parse_args(words, namespace=copy.copy(args))
+            jobs.append((flow_flags(line_args), line_args.input_file))
+    return jobs
+
+
+def flow_flags(args):
+    """Returns the flags that jobs sharing a stage_builder() must agree on."""
+    return (args.top, args.pipeline_stages, args.delay_model)
 
-    # Construct full paths to binaries using the global variable
-    interpreter_main = ["/home/josh_huang/.local/opt/glibc-centos9stream/usr/lib64/ld-linux-x86-64.so.2", "--library-path", "/home/josh_huang/.local/opt/glibc-centos9stream/usr/lib64", os.path.join(GOOGLEXLS_BIN, "interpreter_main")]
-    ir_converter_main = ["/home/josh_huang/.local/opt/glibc-centos9stream/usr/lib64/ld-linux-x86-64.so.2", "--library-path", "/home/josh_huang/.local/opt/glibc-centos9stream/usr/lib64", os.path.join(GOOGLEXLS_BIN, "ir_converter_main"), f"--top={args.top}"]
-    opt_main = ["/home/josh_huang/.local/opt/glibc-centos9stream/usr/lib64/ld-linux-x86-64.so.2", "--library-path", "/home/josh_huang/.local/opt/glibc-centos9stream/usr/lib64", os.path.join(GOOGLEXLS_BIN, "opt_main")]
-    codegen_main = ["/home/josh_huang/.local/opt/glibc-centos9stream/usr/lib64/ld-linux-x86-64.so.2", "--library-path", "/home/josh_huang/.local/opt/glibc-centos9stream/usr/lib64", os.path.join(GOOGLEXLS_BIN, "codegen_main"), f"--pipeline_stages={args.pipeline_stages}", f"--delay_model={args.delay_model}"]
 
-    run_command(interpreter_main, input_file, "/dev/null")
-    run_command(ir_converter_main, f"{base_filename}.x", f"{base_filename}.ir")
-    run_command(opt_main, f"{base_filename}.ir", f"{base_filename}.opt.ir")
-    run_command(codegen_main, f"{base_filename}.opt.ir", f"{base_filename}.v")
+def stage_builder(top, pipeline_stages, delay_model):
+    """Returns make_cmds(input_file) -> (interpreter_main, stages).
+
+    The command lines and their flags are formatted here, once per flag set;
+    make_cmds only pairs the prebuilt commands with one file's paths, each of
+    which is built once and shared by the stages that read and write it.
+    """
+    interpreter_main = tool_command("interpreter_main")
+    ir_converter_main = tool_command("ir_converter_main", f"--top={top}")
+    opt_main = tool_command("opt_main")
+    codegen_main = tool_command("codegen_main", f"--pipeline_stages={pipeline_stages}", f"--delay_model={delay_model}")
+
+    def make_cmds(input_file):
+        base_filename = os.path.splitext(input_file)[0]
+        x, ir, opt_ir, v = (base_filename + ext for ext in (".x", ".ir", ".opt.ir", ".v"))
+        return interpreter_main, [
+            (ir_converter_main, x, ir),
+            (opt_main, ir, opt_ir),
+            (codegen_main, opt_ir, v),
+        ]
+
+    return make_cmds
+
+
+async def process(make_cmds, input_file, args, limits):
+    """Runs the DSLX -> IR -> optimized IR -> Verilog flow for one file.
+
+    limits holds one semaphore for the interpreter check and one for the
+    conversion pipeline, so that one file can be converted while the next is
+    being checked. Raises subprocess.CalledProcessError for the first stage
+    that fails.
+    """
+    check_limit, convert_limit = limits
+    interpreter_main, stages = make_cmds(input_file)
+
+    # The tools are chatty even when they succeed, so their stderr is only
+    # kept with --verbose.
+    stderr = None if args.verbose else subprocess.DEVNULL
+    imports = None if args.no_cache else dslx_imports(input_file)
+    root_key = dslx_key(input_file, imports)
+    async with check_limit:
+        await run_check(interpreter_main, input_file, root_key, stderr)
+    async with convert_limit:
+        if args.no_cache:
+            stale = stages
+            remove_stamps(stale)
+            await run_pipeline(stale, stderr)
+        else:
+            start = first_stale_stage(stages, imports)
+            for _, _, output_file in stages[:start]:
+                print(f"Up to date: {output_file}")
+            stale = stages[start:]
+            remove_stamps(stale)
+            if stale:
+                stale_input = stale[0][1]
+                if stale_input != input_file:
+                    await run_cached(stale, file_key(stale_input), stderr)
+                elif root_key is not None:
+                    await run_cached(stale, root_key, stderr)
+                else:
+                    # An import we cannot resolve may change unseen, so its
+                    # importer is never served from the cache.
+                    await run_pipeline(stale, stderr)
+        write_stamps(stale)
 
     print("Success! Output files created:")
-    print(f"{base_filename}.x")
-    print(f"{base_filename}.ir")
-    print(f"{base_filename}.opt.ir")
-    print(f"{base_filename}.v")
+    print(stages[0][1])
+    for _, _, output_file in stages:
+        print(output_file)
+
+
+async def process_all(jobs, args):
+    """Runs process() on every (flags, input_file) job.
+
+    At most args.jobs files are in each of the check and conversion phases at
+    once. Jobs are grouped by flags so that each group shares one
+    stage_builder(). Returns each job's exception, or None if it succeeded.
+    """
+    groups = {}
+    for flags, input_file in jobs:
+        groups.setdefault(flags, []).append(input_file)
+    limits = (asyncio.Semaphore(args.jobs), asyncio.Semaphore(args.jobs))
+    tasks = []
+    for flags, input_files in groups.items():
+        make_cmds = stage_builder(*flags)
+        tasks += [process(make_cmds, input_file, args, limits) for input_file in input_files]
+    return await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def build(args):
+    """Builds every input file; returns 1 if any of them failed, else 0.
+
+    Returns 2, building nothing, if two different jobs would write the same
+    outputs.
+    """
+    jobs = [(flow_flags(args), input_file) for input_file in args.input_files]
+    if args.batch:
+        jobs += read_manifest(args.batch, args)
+    # Jobs for the same base name write the same outputs and stamps, so they
+    # cannot run side by side; a job listed twice is only run once.
+    by_output = {}
+    for flags, input_file in jobs:
+        base = os.path.abspath(os.path.splitext(input_file)[0])
+        job = by_output.setdefault(base, (flags, input_file))
+        if job[0] != flags or os.path.abspath(job[1]) != os.path.abspath(input_file):
+            print(f"Error: {job[1]} and {input_file} would both write {base}.ir, .opt.ir and .v")
+            return 2
+    jobs = list(by_output.values())
+    failed = False
+    for error in asyncio.run(process_all(jobs, args)):
+        if isinstance(error, (subprocess.CalledProcessError, OSError)):
+            print(f"Error: {error}")
+            failed = True
+        elif error is not None:
+            raise error
+    if failed:
+        if not args.verbose:
+            print("Rerun with --verbose to see the tools' error output.")
+        return 1
+    return 0
+
+
+def main():
+    cloexec_inherited_fds()
+    args = parse_args(sys.argv[1:])
+    if args.serve:
+        serve()
+        return
+    code = forward(sys.argv[1:])
+    if code is not None:
+        exit(code)
+    exit(build(args))
 
 
 if __name__ == "__main__":
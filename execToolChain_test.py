@@ -0,0 +1,177 @@
+"""Tests for execToolChain.py, run against stub tools in a scratch directory."""
+
+import contextlib
+import errno
+import io
+import os
+import stat
+import tempfile
+import unittest
+
+import execToolChain
+
+
+# Each stub copies its input ("-" is stdin) to stdout. opt_main fails once it
+# has written its output if a file named FAIL exists, as a crashing tool would.
+STUB_TOOLS = {
+    "interpreter_main": '#!/bin/sh\nexit 0\n',
+    "ir_converter_main": '#!/bin/sh\nfor arg; do :; done\ncat "$arg"\n',
+    "opt_main": '#!/bin/sh\ncat\ntest ! -e FAIL\n',
+    "codegen_main": '#!/bin/sh\ncat\n',
+}
+
+
+class ExecToolChainTest(unittest.TestCase):
+
+    def setUp(self):
+        scratch = tempfile.TemporaryDirectory()
+        self.addCleanup(scratch.cleanup)
+        tools = os.path.join(scratch.name, "bin")
+        os.mkdir(tools)
+        tool_paths = {}
+        for name, script in STUB_TOOLS.items():
+            tool_paths[name] = os.path.join(tools, name)
+            with open(tool_paths[name], 'w') as f:
+                f.write(script)
+            os.chmod(tool_paths[name], stat.S_IRWXU)
+        cache = os.path.join(scratch.name, "cache")
+        patches = {
+            "TOOL_PATHS": tool_paths,
+            "LOADER_PREFIX": (),
+            "CACHE_DIR": cache,
+            "CHECKED_DIR": os.path.join(cache, "interp_ok"),
+            "STAMP_DIR": os.path.join(cache, "stamps"),
+        }
+        for name, value in patches.items():
+            self.addCleanup(setattr, execToolChain, name, getattr(execToolChain, name))
+            setattr(execToolChain, name, value)
+        execToolChain.tool_launcher.cache_clear()
+        self.addCleanup(execToolChain.tool_launcher.cache_clear)
+        self.work = os.path.join(scratch.name, "work")
+        os.mkdir(self.work)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.work)
+
+    def build(self, *argv):
+        """Runs a direct build; returns its output and exit code."""
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            code = execToolChain.build(execToolChain.parse_args(list(argv)))
+        return output.getvalue(), code
+
+    def write(self, path, text):
+        with open(path, 'w') as f:
+            f.write(text)
+
+    def read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def test_dslx_imports(self):
+        os.makedirs("a")
+        self.write("a/b.x", "import mod;\n")
+        self.write("mod.x", "pub fn member() {}\n")
+        self.write("top.x", "import std;\nimport a.b;\nuse mod::member;\nuse std::clog2;\n")
+        self.assertEqual(execToolChain.dslx_imports("top.x"), ["a/b.x", "mod.x"])
+
+    def test_dslx_imports_unresolvable(self):
+        self.write("top.x", "import std;\nimport missing.module;\n")
+        self.assertIsNone(execToolChain.dslx_imports("top.x"))
+        self.assertIsNone(execToolChain.dslx_key("top.x", None))
+
+    def test_changed_import_is_rebuilt(self):
+        self.write("mod.x", "pub fn member() {}\n")
+        self.write("top.x", "use mod::member;\nuse std::clog2;\n")
+        self.assertEqual(self.build("top.x")[1], 0)
+        output, code = self.build("top.x")
+        self.assertEqual(output.count("Up to date"), 3)
+        self.assertIn("Already checked", output)
+
+        self.write("mod.x", "pub fn member() { changed }\n")
+        newer = os.stat("top.ir").st_mtime_ns + 10**9
+        os.utime("mod.x", ns=(newer, newer))
+        output, code = self.build("top.x")
+        self.assertEqual(code, 0)
+        self.assertNotIn("Up to date", output)
+        self.assertNotIn("Already checked", output)
+        self.assertNotIn("Cache hit", output)
+
+    def test_cached_outputs_are_read_only(self):
+        self.write("top.x", "fn add() {}\n")
+        self.assertEqual(self.build("top.x")[1], 0)
+        for output_file in ("top.ir", "top.opt.ir", "top.v"):
+            self.assertEqual(stat.S_IMODE(os.stat(output_file).st_mode), 0o444, output_file)
+            os.unlink(output_file)
+        output, code = self.build("top.x")
+        self.assertEqual(output.count("Cache hit"), 3)
+        for output_file in ("top.ir", "top.opt.ir", "top.v"):
+            self.assertEqual(stat.S_IMODE(os.stat(output_file).st_mode), 0o444, output_file)
+
+    def test_failed_build_is_rebuilt(self):
+        self.write("top.x", "fn add() {}\n")
+        self.assertEqual(self.build("top.x")[1], 0)
+
+        # A failing opt_main still writes its output, and all outputs from
+        # the successful build above have matching stamps.
+        self.write("top.x", "fn add() { changed }\n")
+        self.write("FAIL", "")
+        output, code = self.build("top.x")
+        self.assertEqual(code, 1)
+        self.assertNotIn("Success!", output)
+        for output_file in ("top.ir", "top.opt.ir", "top.v"):
+            self.assertFalse(os.path.exists(output_file), output_file)
+
+        os.unlink("FAIL")
+        output, code = self.build("top.x")
+        self.assertEqual(code, 0)
+        self.assertNotIn("Up to date", output)
+        self.assertEqual(self.read("top.v"), "fn add() { changed }\n")
+
+    def test_failed_build_is_not_cached(self):
+        self.write("top.x", "fn add() {}\n")
+        self.write("FAIL", "")
+        self.assertEqual(self.build("--no_cache", "top.x")[1], 1)
+        self.assertFalse(os.path.exists("top.ir"))
+
+        os.unlink("FAIL")
+        output, code = self.build("top.x")
+        self.assertEqual(code, 0)
+        self.assertNotIn("Up to date", output)
+        self.assertNotIn("Cache hit", output)
+
+    def test_jobs_writing_the_same_outputs_are_rejected(self):
+        self.write("a.x", "fn add() {}\n")
+        self.write("m.txt", "a.x --pipeline_stages=2\n")
+        output, code = self.build("--jobs=4", "--batch=m.txt", "a.x")
+        self.assertEqual(code, 2)
+        self.assertNotIn("Success!", output)
+        self.assertFalse(os.path.exists("a.ir"))
+
+    def test_repeated_job_runs_once(self):
+        self.write("a.x", "fn add() {}\n")
+        output, code = self.build("--jobs=4", "a.x", "./a.x")
+        self.assertEqual(code, 0)
+        self.assertEqual(output.count("Success!"), 1)
+
+    def test_failed_tee_reaps_every_stage(self):
+        # Enough output that ir_converter_main blocks once nothing reads it.
+        self.write("top.x", "fn add() {}\n" * 100000)
+        tee = execToolChain.tee
+
+        async def tee_out_of_space(src, output_file, dst):
+            if output_file == "top.ir":
+                os.close(dst)
+                raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC), output_file)
+            await tee(src, output_file, dst)
+
+        self.addCleanup(setattr, execToolChain, "tee", tee)
+        execToolChain.tee = tee_out_of_space
+        output, code = self.build("--no_cache", "top.x")
+        self.assertEqual(code, 1)
+        self.assertIn("No space left on device", output)
+        with self.assertRaises(ChildProcessError):
+            os.waitpid(-1, os.WNOHANG)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -26,6 +26,7 @@
 #include <variant>
 #include <vector>
 
+#include "absl/base/no_destructor.h"
 #include "absl/container/btree_set.h"
 #include "absl/container/flat_hash_map.h"
 #include "absl/log/check.h"
@@ -547,7 +548,10 @@ absl::Status FunctionConverter::DefAlias(const AstNode* from,
 absl::StatusOr<BValue> FunctionConverter::DefWithStatus(
     const AstNode* node,
     const std::function<absl::StatusOr<BValue>(const SourceInfo&)>& ir_func) {
-  SourceInfo loc = ToSourceInfo(node->GetSpan());
+  // GetSpan() is virtual and copies the span; skip it when it would only be
+  // discarded.
+  SourceInfo loc =
+      options_.emit_positions ? ToSourceInfo(node->GetSpan()) : SourceInfo();
   XLS_ASSIGN_OR_RETURN(BValue result, ir_func(loc));
   VLOG(6) << absl::StreamFormat("Define node '%s' (%s) to be %s @ %s",
                                 node->ToString(), node->GetNodeTypeName(),
@@ -583,7 +587,8 @@ FunctionConverter::CValue FunctionConverter::DefConst(const AstNode* node,
     return function_builder_->Literal(ir_value, loc);
   };
   BValue result = Def(node, ir_func);
-  CValue c_value{ir_value, result};
+  // The literal holds its own copy of the value, so ours can be moved.
+  CValue c_value{std::move(ir_value), result};
   SetNodeToIr(node, c_value);
   return c_value;
 }
@@ -686,7 +691,7 @@ absl::Status FunctionConverter::HandleNumber(const Number* node) {
   XLS_ASSIGN_OR_RETURN(int64_t bit_count,
                        std::get<InterpValue>(dim.value()).GetBitValueViaSign());
   XLS_ASSIGN_OR_RETURN(Bits bits, node->GetBits(bit_count, file_table()));
-  DefConst(node, Value(bits));
+  DefConst(node, Value(std::move(bits)));
   return absl::OkStatus();
 }
 
@@ -696,7 +701,7 @@ absl::Status FunctionConverter::HandleString(const String* node) {
     elements.push_back(Value(UBits(letter, /*bit_count=*/8)));
   }
   XLS_ASSIGN_OR_RETURN(Value array, Value::Array(elements));
-  DefConst(node, array);
+  DefConst(node, std::move(array));
   return absl::OkStatus();
 }
 
@@ -1253,7 +1258,7 @@ absl::StatusOr<FunctionConverter::RangeData> FunctionConverter::GetRangeData(
   // Easy case first: using the `..` range operator.
   InterpValue start_value(InterpValue::MakeToken());
   InterpValue limit_value(InterpValue::MakeToken());
-  ParametricEnv bindings(parametric_env_map_);
+  const ParametricEnv& bindings = parametric_env_;
 
   const auto* range_op = dynamic_cast<const Range*>(iterable);
   if (range_op != nullptr) {
@@ -1432,9 +1437,8 @@ absl::Status FunctionConverter::HandleFor(const For* node) {
     // still want to make the loop with the same pattern.
     AstNode* accum = carry_node;
     XLS_ASSIGN_OR_RETURN(std::unique_ptr<Type> carry_type, ResolveType(accum));
-    XLS_ASSIGN_OR_RETURN(
-        xls::Type * carry_ir_type,
-        TypeToIr(package(), *carry_type, ParametricEnv(parametric_env_map_)));
+    XLS_ASSIGN_OR_RETURN(xls::Type * carry_ir_type,
+                         TypeToIr(package(), *carry_type, parametric_env_));
     BValue carry;
     if (implicit_token_data_.has_value()) {
       carry = body_converter.AddTokenWrappedParam(carry_ir_type);
@@ -1464,7 +1468,7 @@ absl::Status FunctionConverter::HandleFor(const For* node) {
   FreeVariables freevars =
       GetFreeVariablesByPos(node->body(), &node->span().start());
   freevars = freevars.DropBuiltinDefs();
-  std::vector<const NameDef*> relevant_name_defs;
+  std::vector<BValue> invariant_args;
   for (const auto& any_name_def : freevars.GetNameDefs()) {
     const auto* freevar_name_def = std::get<const NameDef*>(any_name_def);
     std::optional<const Type*> type =
@@ -1493,18 +1497,21 @@ absl::Status FunctionConverter::HandleFor(const For* node) {
     // This preserves const-ness of loop body uses (e.g. loop bounds for
     // a nested loop).
     if (std::holds_alternative<CValue>(*ir_value)) {
-      Value constant_value = std::get<CValue>(*ir_value).ir_value;
-      body_converter.DefConst(freevar_name_def, constant_value);
+      // `ir_value` is our own copy, so its value can be moved into the body.
+      body_converter.DefConst(freevar_name_def,
+                              std::move(std::get<CValue>(*ir_value).ir_value));
     } else {
       // Otherwise, pass in the variable to the loop body function as
-      // a parameter.
-      relevant_name_defs.push_back(freevar_name_def);
-      XLS_ASSIGN_OR_RETURN(
-          xls::Type * name_def_type,
-          TypeToIr(package(), **type, ParametricEnv(parametric_env_map_)));
+      // a parameter, typed like the value we pass for it.
+      XLS_RET_CHECK(std::holds_alternative<BValue>(*ir_value))
+          << "Loop body cannot capture a channel: "
+          << freevar_name_def->ToString();
+      BValue value = std::get<BValue>(*ir_value);
+      invariant_args.push_back(value);
       body_converter.SetNodeToIr(
-          freevar_name_def, body_converter.AddParam(
-                                freevar_name_def->identifier(), name_def_type));
+          freevar_name_def,
+          body_converter.AddParam(freevar_name_def->identifier(),
+                                  value.GetType()));
     }
   }
 
@@ -1551,12 +1558,6 @@ absl::Status FunctionConverter::HandleFor(const For* node) {
                        body_builder_ptr->Build());
   VLOG(5) << "Converted body function: " << body_function->name();
 
-  std::vector<BValue> invariant_args;
-  for (const NameDef* nd : relevant_name_defs) {
-    XLS_ASSIGN_OR_RETURN(BValue value, Use(nd));
-    invariant_args.push_back(value);
-  }
-
   XLS_ASSIGN_OR_RETURN(BValue init, Use(node->init()));
   if (implicit_token_data_.has_value()) {
     BValue activated = range_data.trip_count == 0
@@ -1933,7 +1934,7 @@ absl::Status FunctionConverter::HandleUdfInvocation(const Invocation* node,
 absl::StatusOr<FunctionConverter::AssertionLabelData>
 FunctionConverter::GetAssertionLabel(std::string_view caller_name,
                                      const Expr* label_expr, const Span& span) {
-  ParametricEnv bindings(parametric_env_map_);
+  const ParametricEnv& bindings = parametric_env_;
   XLS_RETURN_IF_ERROR(
       ConstexprEvaluator::Evaluate(import_data_, current_type_info_,
                                    kNoWarningCollector, bindings, label_expr));
@@ -2086,7 +2087,7 @@ absl::Status FunctionConverter::HandleFormatMacro(const FormatMacro* node) {
     absl::StatusOr<InterpValue> verbosity_interp_value =
         ConstexprEvaluator::EvaluateToValue(
             import_data_, current_type_info_, kNoWarningCollector,
-            ParametricEnv(parametric_env_map_), *node->verbosity(), nullptr);
+            parametric_env_, *node->verbosity(), nullptr);
     if (!verbosity_interp_value.ok()) {
       return IrConversionErrorStatus(
           (*node->verbosity())->span(),
@@ -2158,10 +2159,17 @@ absl::Status FunctionConverter::HandleCoverBuiltin(const Invocation* node,
 absl::Status FunctionConverter::HandleInvocation(const Invocation* node) {
   VLOG(5) << "FunctionConverter::HandleInvocation: " << node->ToString();
   XLS_ASSIGN_OR_RETURN(std::string called_name, GetCalleeIdentifier(node));
+  auto visit_args = [&]() -> absl::Status {
+    for (Expr* arg : node->args()) {
+      XLS_RETURN_IF_ERROR(Visit(arg));
+    }
+    return absl::OkStatus();
+  };
   auto accept_args = [&]() -> absl::StatusOr<std::vector<BValue>> {
+    XLS_RETURN_IF_ERROR(visit_args());
     std::vector<BValue> values;
+    values.reserve(node->args().size());
     for (Expr* arg : node->args()) {
-      XLS_RETURN_IF_ERROR(Visit(arg));
       XLS_ASSIGN_OR_RETURN(BValue value, Use(arg));
       values.push_back(value);
     }
@@ -2246,9 +2254,9 @@ absl::Status FunctionConverter::HandleInvocation(const Invocation* node) {
   }
 
   // The rest of the builtins have "handle" methods we can resolve.
-  absl::flat_hash_map<std::string,
-                      decltype(&FunctionConverter::HandleBuiltinClz)>
-      map = {
+  static const absl::NoDestructor<absl::flat_hash_map<
+      std::string, decltype(&FunctionConverter::HandleBuiltinClz)>>
+      map({
           {"array_rev", &FunctionConverter::HandleBuiltinArrayRev},
           {"array_size", &FunctionConverter::HandleBuiltinArraySize},
           {"clz", &FunctionConverter::HandleBuiltinClz},
@@ -2272,9 +2280,9 @@ absl::Status FunctionConverter::HandleInvocation(const Invocation* node) {
           {"update", &FunctionConverter::HandleBuiltinUpdate},
           {"umulp", &FunctionConverter::HandleBuiltinUMulp},
           {"smulp", &FunctionConverter::HandleBuiltinSMulp},
-      };
-  auto it = map.find(called_name);
-  if (it == map.end()) {
+      });
+  auto it = map->find(called_name);
+  if (it == map->end()) {
     return IrConversionErrorStatus(
         node->span(),
         absl::StrFormat("Could not find name for "
@@ -2283,7 +2291,8 @@ absl::Status FunctionConverter::HandleInvocation(const Invocation* node) {
                         absl::StrJoin(module_->GetFunctionNames(), ", ")),
         file_table());
   }
-  XLS_RETURN_IF_ERROR(accept_args().status());
+  // These handlers look up their (already converted) args themselves.
+  XLS_RETURN_IF_ERROR(visit_args());
   auto f = it->second;
   return (this->*f)(node);
 }
@@ -2401,7 +2410,7 @@ absl::Status FunctionConverter::HandleRange(const Range* node) {
   }
 
   XLS_ASSIGN_OR_RETURN(Value array, Value::Array(elements));
-  DefConst(node, array);
+  DefConst(node, std::move(array));
   return absl::OkStatus();
 }
 
@@ -2709,7 +2718,8 @@ absl::Status FunctionConverter::HandleFunction(
                          parametric_type->GetTotalBitCount());
     XLS_ASSIGN_OR_RETURN(Value param_value,
                          InterpValueToValue(*parametric_value));
-    const CValue evaluated = DefConst(parametric_binding, param_value);
+    const CValue evaluated =
+        DefConst(parametric_binding, std::move(param_value));
     const_prefill.SetNamedValue(parametric_binding->name_def()->identifier(),
                                 evaluated.ir_value);
     XLS_RETURN_IF_ERROR(
@@ -2875,7 +2885,7 @@ absl::Status FunctionConverter::HandleProcNextFunction(
                            parametric_value->GetBitValueViaSign());
       param_value = Value(UBits(bit_value, bit_count));
     }
-    DefConst(parametric_binding, param_value);
+    DefConst(parametric_binding, std::move(param_value));
     XLS_RETURN_IF_ERROR(
         DefAlias(parametric_binding, /*to=*/parametric_binding->name_def()));
   }
@@ -2918,7 +2928,8 @@ absl::Status FunctionConverter::HandleColonRef(const ColonRef* node) {
     // constants transitively so we can visit all dependees.
     XLS_ASSIGN_OR_RETURN(
         std::vector<ConstantDef*> constant_deps,
-        GetConstantDepFreevars(constant_def, *imported.value()->type_info));
+        GetConstantDepFreevars(constant_def, *imported.value()->type_info,
+                               &package_data_.constant_deps));
     for (ConstantDef* dep : constant_deps) {
       XLS_ASSIGN_OR_RETURN(std::optional<ScopedTypeInfoSwap> stis,
                            ScopedTypeInfoSwap::ForNode(this, dep));
@@ -2965,7 +2976,7 @@ absl::Status FunctionConverter::HandleColonRef(const ColonRef* node) {
                 InterpValue interp_value,
                 GetBuiltinNameDefColonAttr(builtin_name_def, node->attr()));
             XLS_ASSIGN_OR_RETURN(Value value, InterpValueToValue(interp_value));
-            DefConst(node, value);
+            DefConst(node, std::move(value));
             return absl::OkStatus();
           },
           [&](ArrayTypeAnnotation* array_type) -> absl::Status {
@@ -2985,14 +2996,14 @@ absl::Status FunctionConverter::HandleColonRef(const ColonRef* node) {
                 InterpValue interp_value,
                 GetArrayTypeColonAttr(array_type, bit_count, node->attr()));
             XLS_ASSIGN_OR_RETURN(Value value, InterpValueToValue(interp_value));
-            DefConst(node, value);
+            DefConst(node, std::move(value));
             return absl::OkStatus();
           },
           [&](Impl* impl) -> absl::Status {
             XLS_ASSIGN_OR_RETURN(InterpValue iv,
                                  current_type_info_->GetConstExpr(node));
             XLS_ASSIGN_OR_RETURN(Value value, InterpValueToValue(iv));
-            DefConst(node, value);
+            DefConst(node, std::move(value));
             return absl::OkStatus();
           }},
       subject);
@@ -3074,14 +3085,23 @@ absl::StatusOr<std::string> FunctionConverter::GetCalleeIdentifier(
     return callee_name;
   }
   Function* f = maybe_f.value();
+  if (!f->IsParametric()) {
+    // The name is the same at every call site, so it is mangled only once.
+    auto it = package_data_.mangled_names.find(f);
+    if (it == package_data_.mangled_names.end()) {
+      XLS_ASSIGN_OR_RETURN(
+          std::string mangled_name,
+          MangleDslxName(m->name(), f->identifier(), GetCallingConvention(f)));
+      it = package_data_.mangled_names.emplace(f, std::move(mangled_name))
+               .first;
+    }
+    return it->second;
+  }
 
   // We have to mangle the parametric bindings into the name to get the fully
   // resolved symbol.
   absl::btree_set<std::string> free_keys = f->GetFreeParametricKeySet();
   const CallingConvention convention = GetCallingConvention(f);
-  if (!f->IsParametric()) {
-    return MangleDslxName(m->name(), f->identifier(), convention, free_keys);
-  }
 
   std::optional<const ParametricEnv*> resolved_parametric_env =
       GetInvocationCalleeBindings(node);
@@ -3097,8 +3117,7 @@ absl::StatusOr<std::string> FunctionConverter::GetCalleeIdentifier(
 
 std::optional<const Expr*> FunctionConverter::GetUnrolledForLoop(
     const UnrollFor* loop) {
-  return current_type_info_->GetUnrolledLoop(
-      loop, ParametricEnv(parametric_env_map_));
+  return current_type_info_->GetUnrolledLoop(loop, parametric_env_);
 }
 
 absl::Status FunctionConverter::HandleUnrollFor(const UnrollFor* node) {
@@ -3395,7 +3414,7 @@ absl::Status FunctionConverter::HandleBuiltinArraySize(const Invocation* node) {
   // All array sizes are constexpr since they're based on known types.
   XLS_ASSIGN_OR_RETURN(InterpValue iv, current_type_info_->GetConstExpr(node));
   XLS_ASSIGN_OR_RETURN(Value v, InterpValueToValue(iv));
-  DefConst(node, v);
+  DefConst(node, std::move(v));
   return absl::OkStatus();
 }
 
@@ -3819,7 +3838,7 @@ absl::StatusOr<std::unique_ptr<Type>> FunctionConverter::ResolveType(
   }
 
   return t.value()->MapSize([this](const TypeDim& dim) {
-    return ResolveDim(dim, ParametricEnv(parametric_env_map_));
+    return ResolveDim(dim, parametric_env_);
   });
 }
 
@@ -3848,7 +3867,7 @@ absl::StatusOr<xls::Type*> FunctionConverter::ResolveTypeToIr(
     const AstNode* node) {
   XLS_ASSIGN_OR_RETURN(std::unique_ptr<Type> type, ResolveType(node));
   return TypeToIr(package_data_.conversion_info->package.get(), *type,
-                  ParametricEnv(parametric_env_map_));
+                  parametric_env_);
 }
 
 absl::StatusOr<Value> InterpValueToValue(const InterpValue& iv) {
@@ -3895,7 +3914,13 @@ absl::StatusOr<std::optional<ConstantDef*>> TryResolveConstantDef(
 }
 
 absl::StatusOr<std::vector<ConstantDef*>> GetConstantDepFreevars(
-    AstNode* node, TypeInfo& type_info) {
+    AstNode* node, TypeInfo& type_info, ConstantDepCache* cache) {
+  if (cache != nullptr) {
+    if (auto it = cache->find(std::make_pair(node, &type_info));
+        it != cache->end()) {
+      return it->second;
+    }
+  }
   Span span = node->GetSpan().value();
   FreeVariables free_variables = GetFreeVariablesByPos(node, &span.start());
   std::vector<std::pair<std::string, AnyNameDef>> freevars =
@@ -3907,34 +3932,48 @@ absl::StatusOr<std::vector<ConstantDef*>> GetConstantDepFreevars(
     }
     const auto* name_def = std::get<const NameDef*>(any_name_def);
     AstNode* definer = name_def->definer();
-    if (auto* use_tree_entry = dynamic_cast<UseTreeEntry*>(definer);
-        use_tree_entry != nullptr) {
-      XLS_ASSIGN_OR_RETURN(
-          std::optional<ConstantDef*> constant_def,
-          TryResolveConstantDef(identifier, use_tree_entry, type_info));
-      if (constant_def.has_value()) {
+    if (definer == nullptr) {
+      continue;
+    }
+    // Classify the definer with a single switch on its kind; a `use`d name
+    // and a local constant both resolve to the ConstantDef handled below.
+    ConstantDef* constant_def = nullptr;
+    switch (definer->kind()) {
+      case AstNodeKind::kUseTreeEntry: {
         XLS_ASSIGN_OR_RETURN(
-            auto sub_deps,
-            GetConstantDepFreevars(constant_def.value(), type_info));
+            std::optional<ConstantDef*> resolved,
+            TryResolveConstantDef(identifier,
+                                  down_cast<UseTreeEntry*>(definer),
+                                  type_info));
+        constant_def = resolved.value_or(nullptr);
+        break;
+      }
+      case AstNodeKind::kConstantDef:
+        constant_def = down_cast<ConstantDef*>(definer);
+        break;
+      case AstNodeKind::kEnumDef: {
+        XLS_ASSIGN_OR_RETURN(auto sub_deps,
+                             GetConstantDepFreevars(definer, type_info, cache));
         constant_deps.insert(constant_deps.end(), sub_deps.begin(),
                              sub_deps.end());
-        constant_deps.push_back(constant_def.value());
+        break;
       }
-    } else if (auto* constant_def = dynamic_cast<ConstantDef*>(definer)) {
-      XLS_ASSIGN_OR_RETURN(auto sub_deps,
-                           GetConstantDepFreevars(constant_def, type_info));
+      default:
+        // Not something we recognize as needing free variable analysis.
+        break;
+    }
+    if (constant_def != nullptr) {
+      XLS_ASSIGN_OR_RETURN(
+          auto sub_deps,
+          GetConstantDepFreevars(constant_def, type_info, cache));
       constant_deps.insert(constant_deps.end(), sub_deps.begin(),
                            sub_deps.end());
       constant_deps.push_back(constant_def);
-    } else if (auto* enum_def = dynamic_cast<EnumDef*>(definer)) {
-      XLS_ASSIGN_OR_RETURN(auto sub_deps,
-                           GetConstantDepFreevars(enum_def, type_info));
-      constant_deps.insert(constant_deps.end(), sub_deps.begin(),
-                           sub_deps.end());
-    } else {
-      // Not something we recognize as needing free variable analysis.
     }
   }
+  if (cache != nullptr) {
+    cache->emplace(std::make_pair(node, &type_info), constant_deps);
+  }
   return constant_deps;
 }
 
@@ -60,13 +60,22 @@ namespace xls::dslx {
 // Converts an interpreter value to an IR value.
 absl::StatusOr<Value> InterpValueToValue(const InterpValue& v);
 
+// Results of `GetConstantDepFreevars()`, keyed on the node that was walked and
+// the type information it was walked with.
+using ConstantDepCache =
+    absl::flat_hash_map<std::pair<const AstNode*, const TypeInfo*>,
+                        std::vector<ConstantDef*>>;
+
 // For all free variables of "node", adds them transitively for any required
 // constant dependencies to the converter.
 //
+// If "cache" is given, results for "node" and every constant visited on the
+// way are memoized there, so shared constants are only walked once.
+//
 // Warning: the `ConstantDef`s may be owned by different modules, e.g. if we had
 // to traverse a name that was `use`d into the current module.
 absl::StatusOr<std::vector<ConstantDef*>> GetConstantDepFreevars(
-    AstNode* node, TypeInfo& type_info);
+    AstNode* node, TypeInfo& type_info, ConstantDepCache* cache = nullptr);
 
 // Wrapper around the type information query for whether DSL function "f"
 // requires an implicit token calling convention.
@@ -92,6 +101,10 @@ struct PackageData {
   PackageConversionData* conversion_info;
   absl::flat_hash_map<xls::FunctionBase*, dslx::Function*> ir_to_dslx;
   absl::flat_hash_set<xls::Function*> wrappers;
+  // Constant dependencies already computed while converting this package.
+  ConstantDepCache constant_deps;
+  // Mangled IR names of the non-parametric DSLX functions invoked so far.
+  absl::flat_hash_map<const dslx::Function*, std::string> mangled_names;
 };
 
 // A function that creates/returns a predicate value -- since this is used
@@ -264,10 +277,12 @@ class FunctionConverter {
 
   void SetParametricEnv(const ParametricEnv* value) {
     parametric_env_map_ = value->ToMap();
+    parametric_env_ = *value;
   }
   void set_parametric_env_map(
       absl::flat_hash_map<std::string, InterpValue> map) {
     parametric_env_map_ = std::move(map);
+    parametric_env_ = ParametricEnv(parametric_env_map_);
   }
 
   // Gets the current counter of counted_for loops we've observed and bumps it.
@@ -287,11 +302,7 @@ class FunctionConverter {
     return it->second;
   }
 
-  // Note: this object holds a map, but we can return a ParametricEnv object
-  // on demand.
-  ParametricEnv GetParametricEnv() const {
-    return ParametricEnv(parametric_env_map_);
-  }
+  const ParametricEnv& GetParametricEnv() const { return parametric_env_; }
 
   // Returns the parametric env to be used in the callee for this invocation.
   //
@@ -307,7 +318,7 @@ class FunctionConverter {
   //  spawn).
   std::optional<const ParametricEnv*> GetInvocationCalleeBindings(
       const Invocation* invocation) const {
-    ParametricEnv key = GetParametricEnv();
+    const ParametricEnv& key = GetParametricEnv();
     return import_data_->GetRootTypeInfo(invocation->owner())
         .value()
         ->GetInvocationCalleeBindings(invocation, key);
@@ -534,6 +545,11 @@ class FunctionConverter {
   // integral values parametrics are taking on).
   absl::flat_hash_map<std::string, InterpValue> parametric_env_map_;
 
+  // The same bindings as `parametric_env_map_` in sorted ParametricEnv form,
+  // kept alongside it so that type resolution (which needs it for every type
+  // dimension) does not rebuild and re-sort it on each call.
+  ParametricEnv parametric_env_;
+
   // File number for use in source positions.
   xls::Fileno ir_fileno_;
 
@@ -178,7 +178,8 @@ absl::Status ConvertOneFunctionInternal(PackageData& package_data,
                               record.IsTop());
   XLS_ASSIGN_OR_RETURN(
       auto constant_deps,
-      GetConstantDepFreevars(record.f()->body(), *record.type_info()));
+      GetConstantDepFreevars(record.f()->body(), *record.type_info(),
+                             &package_data.constant_deps));
   for (const auto& dep : constant_deps) {
     converter.AddConstantDep(dep);
   }